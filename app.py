@@ -5,6 +5,9 @@ import time
 import threading
 import io
 import uuid
+import atexit
+import hashlib
+from datetime import datetime, timedelta, timezone
 import psycopg2
 import requests
 from flask import Flask, request
@@ -16,6 +19,7 @@ from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 from googleapiclient.discovery import build
 from googleapiclient.http import MediaIoBaseUpload
+from googleapiclient.errors import HttpError
 
 # Environment variables
 DATABASE_URL = os.getenv("DATABASE_URL")  # PostgreSQL URL from Render
@@ -24,6 +28,15 @@ AIRTABLE_BASE_ID = os.getenv("AIRTABLE_BASE_ID")
 AIRTABLE_TABLE_NAME = os.getenv("AIRTABLE_TABLE_NAME")
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 TELEGRAM_CHAT_ID = os.getenv("TELEGRAM_CHAT_ID")
+# Bot API base URL (override to point at a local Telegram stand-in)
+TELEGRAM_API_BASE_URL = os.getenv("TELEGRAM_API_BASE_URL", "https://api.telegram.org")
+
+# Telegram ingestion mode: "webhook" (POST /receive_telegram_message) or "poll" (getUpdates long polling).
+# In poll mode every update is handled by the single poller thread, so the bot state
+# (pending_voice, pending_diary) lives in that one process and the webhook route is disabled.
+TELEGRAM_MODE = os.getenv("TELEGRAM_MODE", "webhook")
+TELEGRAM_POLL_BATCH_SIZE = int(os.getenv("TELEGRAM_POLL_BATCH_SIZE", "100"))  # getUpdates limit (1-100)
+TELEGRAM_POLL_TIMEOUT = int(os.getenv("TELEGRAM_POLL_TIMEOUT", "30"))  # long-poll timeout in seconds
 
 # ElevenLabs credentials (for voice generation)
 ELEVENLABS_API_KEY = os.getenv("ELEVENLABS_API_KEY")
@@ -32,6 +45,9 @@ ELEVENLABS_VOICE_ID = os.getenv("ELEVENLABS_VOICE_ID")
 # Google Drive folder ID for storing voice files (the "Voice" folder)
 DRIVE_VOICE_FOLDER_ID = os.getenv("DRIVE_VOICE_FOLDER_ID")
 
+# Voice-folder files not used for this many days are pruned by the retention job (0 disables it)
+VOICE_RETENTION_DAYS = int(os.getenv("VOICE_RETENTION_DAYS", "30"))
+
 # Base URL for Macrodroid endpoints.
 # For audio messages, we send to /getaudio; for text messages, /reply.
 MACROTRIGGER_BASE_URL = "https://trigger.macrodroid.com/9ddf8fe0-30cd-4343-b88a-4d14641c850f"
@@ -42,12 +58,34 @@ SCOPES = ['https://www.googleapis.com/auth/drive.file']
 # In-memory store for processed Telegram update IDs (to avoid duplicate processing)
 processed_updates = set()
 
+# Coalescing window (seconds) for bursty inbound texts from the same phone.
+# Texts arriving inside the window are merged into one Telegram message; 0 disables coalescing.
+# While coalescing, /receive_text answers 200 "Message queued" right away, so unknown phones
+# no longer get a 404; their texts are counted as dropped when the window is flushed.
+TEXT_COALESCE_WINDOW = float(os.getenv("TEXT_COALESCE_WINDOW", "0"))
+
+# Telegram rejects sendMessage texts longer than this
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# Pending inbound texts keyed by phone, waiting for their coalescing window to close
+pending_texts = {}
+pending_text_timers = {}
+pending_texts_lock = threading.Lock()
+
+# Counters showing how much inbound traffic is collapsed by coalescing
+coalesce_stats = {
+    "received": 0,   # texts accepted by /receive_text
+    "forwarded": 0,  # Telegram messages actually sent
+    "collapsed": 0,  # texts merged into an already pending batch
+    "dropped": 0     # texts discarded (unknown phone, DB failure or failed Telegram send)
+}
+
 # Global flag for diary update mode (triggered by /note command)
 pending_diary = False
 
 # Global pending voice message store (for ElevenLabs voice integration)
 # It will store: simp_id (if extracted), voice_text (cleaned text sent to ElevenLabs),
-# voice_data (binary at 320kbps), and phone (intended recipient's phone)
+# clip (audio clip dict from load_voice_clip, audio at 320kbps), and phone (intended recipient's phone)
 pending_voice = None
 
 # Smart strings dictionary (used for text messages)
@@ -126,12 +164,28 @@ def get_drive_service():
     return service
 
 
-def upload_audio_to_gdrive(audio_data, file_name):
+def upload_audio_to_gdrive(clip, file_name):
     """
-    Uploads audio_data to Google Drive in the "Voice" folder,
+    Uploads the clip's audio to Google Drive in the "Voice" folder,
     names the file as file_name, and returns its public download URL.
+    A clip that already has a Drive file reuses it as long as the file still exists.
     """
+    audio_hash = clip["audio_hash"]
     service = get_drive_service()
+    if clip.get("drive_file_id"):
+        try:
+            file_info = service.files().get(fileId=clip["drive_file_id"], fields='webContentLink, trashed').execute()
+            if not file_info.get('trashed'):
+                print(f"DEBUG: Reusing Google Drive file {clip['drive_file_id']} for audio {audio_hash[:12]}", flush=True)
+                save_audio_asset(audio_hash)
+                return file_info.get('webContentLink') or clip["drive_url"]
+            print(f"DEBUG: Google Drive file {clip['drive_file_id']} is trashed, uploading again", flush=True)
+        except HttpError as e:
+            print(f"DEBUG: Google Drive file {clip['drive_file_id']} unavailable ({e}), uploading again", flush=True)
+    audio_data = get_clip_audio(clip)
+    if not audio_data:
+        print(f"❌ Drive: No audio data available for {audio_hash[:12]}", flush=True)
+        return None
     file_metadata = {
         'name': file_name,
         'parents': [DRIVE_VOICE_FOLDER_ID]
@@ -146,8 +200,70 @@ def upload_audio_to_gdrive(audio_data, file_name):
     file_info = service.files().get(fileId=file_id, fields='webContentLink').execute()
     audio_url = file_info.get('webContentLink')
     print(f"DEBUG: Uploaded audio to Google Drive as '{file_name}', URL: {audio_url}", flush=True)
+    clip["drive_file_id"] = file_id
+    clip["drive_url"] = audio_url
+    save_audio_asset(audio_hash, drive_file_id=file_id, drive_url=audio_url)
     return audio_url
 
+def prune_voice_folder():
+    """
+    Deletes files in the "Voice" folder not used for VOICE_RETENTION_DAYS
+    and clears their Drive references from the audio asset registry.
+    Files created before the cutoff are kept if the registry shows a more recent use.
+    """
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=VOICE_RETENTION_DAYS)).strftime("%Y-%m-%dT%H:%M:%S")
+    conn = get_db_connection()
+    if not conn:
+        print("❌ Retention: No DB connection, skipping prune.", flush=True)
+        return 0
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            SELECT drive_file_id FROM audio_assets
+            WHERE drive_file_id IS NOT NULL AND last_used >= NOW() - %s * INTERVAL '1 day'
+        """, (VOICE_RETENTION_DAYS,))
+        recently_used = {row[0] for row in cursor.fetchall()}
+    except Exception as e:
+        print(f"❌ Retention: DB query error, skipping prune: {e}", flush=True)
+        cursor.close()
+        conn.close()
+        return 0
+    cursor.close()
+    conn.close()
+    service = get_drive_service()
+    query = f"'{DRIVE_VOICE_FOLDER_ID}' in parents and createdTime < '{cutoff}' and trashed = false"
+    deleted_ids = []
+    page_token = None
+    while True:
+        result = service.files().list(q=query,
+                                      fields='nextPageToken, files(id, name)',
+                                      pageToken=page_token).execute()
+        for f in result.get('files', []):
+            if f['id'] in recently_used:
+                continue
+            try:
+                service.files().delete(fileId=f['id']).execute()
+                deleted_ids.append(f['id'])
+                print(f"DEBUG: Pruned Google Drive file '{f['name']}' ({f['id']})", flush=True)
+            except Exception as e:
+                print(f"❌ Retention: Could not delete {f['id']}: {e}", flush=True)
+        page_token = result.get('nextPageToken')
+        if not page_token:
+            break
+    if deleted_ids:
+        conn = get_db_connection()
+        if conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute("UPDATE audio_assets SET drive_file_id = NULL, drive_url = NULL WHERE drive_file_id = ANY(%s)", (deleted_ids,))
+                conn.commit()
+            except Exception as e:
+                print(f"❌ Retention: DB update error: {e}", flush=True)
+            cursor.close()
+            conn.close()
+    print(f"✅ Retention: Pruned {len(deleted_ids)} Voice file(s) unused for {VOICE_RETENTION_DAYS} days.", flush=True)
+    return len(deleted_ids)
+
 # ---------- Audio Processing Functions ----------
 def compress_audio(audio_data, target_bitrate="320k"):
     try:
@@ -192,17 +308,163 @@ def generate_voice_message(voice_text):
 # ---------- Messaging Functions ----------
 def send_to_telegram(message):
     print(f"🔍 Telegram: Sending text: '{message}'", flush=True)
-    url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
+    url = f"{TELEGRAM_API_BASE_URL}/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
     payload = {"chat_id": TELEGRAM_CHAT_ID, "text": message}
-    response = requests.post(url, json=payload)
+    response = requests.post(url, json=payload, timeout=10)
     print(f"🔍 Telegram: Sent text, response: {response.text}", flush=True)
+    return response
 
-def send_voice_to_telegram(audio_data, caption="Yay or nay?"):
-    url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendAudio"
+def chunk_inbound_text(simp_id, simp_name, messages):
+    """
+    Formats inbound texts as "simp_id | simp_name: ..." Telegram messages, one text per line.
+    Returns a list of (message, text_indices) pairs, each message within TELEGRAM_MESSAGE_LIMIT;
+    overflow starts a new message with the same prefix and single over-long texts are cut into
+    pieces. text_indices holds the positions in messages of the texts a message carries.
+    """
+    emoji = ""  # For text messages, adjust as desired.
+    prefix = f"{emoji}{simp_id} | {simp_name}: "
+    room = TELEGRAM_MESSAGE_LIMIT - len(prefix)
+    lines = []
+    for index, text_message in enumerate(messages):
+        m = re.match(r'^\s*\d+\s*(.*)', text_message)
+        cleaned = m.group(1) if m else text_message
+        lines.extend((cleaned[i:i + room], index) for i in range(0, max(len(cleaned), 1), room))
+    chunks = []
+    current = None
+    for line, index in lines:
+        if current is not None and len(current[0]) + 1 + len(line) <= room:
+            current = (current[0] + "\n" + line, current[1] | {index})
+        else:
+            if current is not None:
+                chunks.append(current)
+            current = (line, {index})
+    chunks.append(current)
+    return [(prefix + chunk, indices) for chunk, indices in chunks]
+
+def format_inbound_text(simp_id, simp_name, messages):
+    return [message for message, indices in chunk_inbound_text(simp_id, simp_name, messages)]
+
+def queue_inbound_text(phone_number, text_message):
+    """
+    Buffers text_message for phone_number. The first text from a phone opens a
+    TEXT_COALESCE_WINDOW timer; later texts inside the window join the same batch.
+    """
+    with pending_texts_lock:
+        coalesce_stats["received"] += 1
+        if phone_number in pending_texts:
+            pending_texts[phone_number].append(text_message)
+            coalesce_stats["collapsed"] += 1
+            print(f"🔍 Coalesce: Merged text into pending batch for {phone_number} ({len(pending_texts[phone_number])} queued)", flush=True)
+            return
+        pending_texts[phone_number] = [text_message]
+        timer = threading.Timer(TEXT_COALESCE_WINDOW, flush_inbound_texts, args=(phone_number,))
+        timer.daemon = True
+        pending_text_timers[phone_number] = timer
+        timer.start()
+    print(f"🔍 Coalesce: Opened {TEXT_COALESCE_WINDOW}s window for {phone_number}", flush=True)
+
+def flush_inbound_texts(phone_number):
+    with pending_texts_lock:
+        messages = pending_texts.pop(phone_number, [])
+        pending_text_timers.pop(phone_number, None)
+    if not messages:
+        return
+    conn = get_db_connection()
+    if not conn:
+        print(f"❌ Coalesce: DB connection failed, dropping {len(messages)} text(s) from {phone_number}.", flush=True)
+        with pending_texts_lock:
+            coalesce_stats["dropped"] += len(messages)
+        return
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT simp_id, simp_name, subscription FROM simps WHERE phone = %s", (phone_number,))
+        simp = cursor.fetchone()
+    except Exception as e:
+        print(f"❌ Coalesce: DB query error: {e}", flush=True)
+        simp = None
+    cursor.close()
+    conn.close()
+    if not simp:
+        print(f"❌ Coalesce: Phone number {phone_number} not found in DB, dropping {len(messages)} text(s).", flush=True)
+        with pending_texts_lock:
+            coalesce_stats["dropped"] += len(messages)
+        return
+    simp_id, simp_name, subscription = simp
+    chunks = chunk_inbound_text(simp_id, simp_name, messages)
+    print(f"🔍 Coalesce: Forwarding {len(messages)} text(s) as {len(chunks)} message(s)", flush=True)
+    failed_texts = set()
+    for formatted_message, text_indices in chunks:
+        try:
+            response = send_to_telegram(formatted_message)
+            sent = response.ok
+        except Exception as e:
+            print(f"❌ Coalesce: Telegram send failed: {e}", flush=True)
+            sent = False
+        with pending_texts_lock:
+            if sent:
+                coalesce_stats["forwarded"] += 1
+            else:
+                failed_texts |= text_indices
+    if failed_texts:
+        print(f"❌ Coalesce: Dropping {len(failed_texts)} of {len(messages)} text(s) from {phone_number}.", flush=True)
+        with pending_texts_lock:
+            coalesce_stats["dropped"] += len(failed_texts)
+
+def flush_all_inbound_texts():
+    """
+    Cancels the open coalescing windows and flushes every pending batch right away,
+    so texts already acknowledged to Macrodroid are not lost on shutdown.
+    """
+    with pending_texts_lock:
+        timers = list(pending_text_timers.values())
+        phones = list(pending_texts.keys())
+    for timer in timers:
+        timer.cancel()
+    if phones:
+        print(f"🔍 Coalesce: Shutting down, flushing {len(phones)} pending batch(es).", flush=True)
+    for phone_number in phones:
+        flush_inbound_texts(phone_number)
+
+def send_voice_to_telegram(clip, caption="Yay or nay?"):
+    """
+    Sends the clip as an audio preview and returns True on success. A registered clip
+    whose file_id Telegram rejects is forgotten and, if its bytes cannot be fetched,
+    regenerated in place with ElevenLabs.
+    """
+    url = f"{TELEGRAM_API_BASE_URL}/bot{TELEGRAM_BOT_TOKEN}/sendAudio"
+    if clip.get("telegram_file_id"):
+        # Telegram already has these bytes; reference them instead of re-uploading
+        data = {"chat_id": TELEGRAM_CHAT_ID, "caption": caption, "audio": clip["telegram_file_id"]}
+        response = requests.post(url, data=data)
+        print(f"DEBUG: send_voice_to_telegram (cached file_id) response: {response.text}", flush=True)
+        if response.ok:
+            save_audio_asset(clip["audio_hash"])
+            return True
+        # The stored file_id is stale (e.g. bot token changed); don't offer this row again
+        save_audio_asset(clip["audio_hash"], telegram_file_id=None)
+        clip["telegram_file_id"] = None
+    audio_data = get_clip_audio(clip)
+    if not audio_data:
+        print(f"DEBUG: No audio data for {clip['audio_hash'][:12]}, regenerating '{clip['voice_text']}'", flush=True)
+        new_clip = load_voice_clip(clip["voice_text"], regenerate=True)
+        if not new_clip:
+            return False
+        clip.update(new_clip)
+        audio_data = clip["voice_data"]
+    audio_hash = clip["audio_hash"]
     files = {"audio": ("voice.mp3", audio_data, "audio/mpeg")}
     data = {"chat_id": TELEGRAM_CHAT_ID, "caption": caption}
     response = requests.post(url, data=data, files=files)
     print(f"DEBUG: send_voice_to_telegram response: {response.text}", flush=True)
+    try:
+        file_id = response.json()["result"]["audio"]["file_id"]
+    except Exception:
+        file_id = None
+    if file_id:
+        clip["telegram_file_id"] = file_id
+        save_audio_asset(audio_hash, telegram_file_id=file_id,
+                         voice_id=ELEVENLABS_VOICE_ID, voice_text=clip["voice_text"])
+    return response.ok
 
 def send_voice_url_to_macrodroid(audio_url, phone, cleaned_text):
     endpoint = f"{MACROTRIGGER_BASE_URL}/getaudio"
@@ -216,6 +478,101 @@ def send_voice_url_to_macrodroid(audio_url, phone, cleaned_text):
     return response
 
 
+# ---------- Audio Asset Registry ----------
+def hash_audio(audio_data):
+    return hashlib.sha256(audio_data).hexdigest()
+
+def find_audio_asset(voice_text):
+    """
+    Returns the most recently used clip registered for voice_text with the current
+    ElevenLabs voice, or None. Only clips that were actually sent (have a Drive file)
+    are returned, so takes rejected with "next" or "cancel" are never served again,
+    and only those Telegram holds a file_id for, since that is where their bytes
+    can be fetched back from.
+    """
+    conn = get_db_connection()
+    if not conn:
+        return None
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            SELECT sha256, telegram_file_id, drive_file_id, drive_url FROM audio_assets
+            WHERE voice_id = %s AND voice_text = %s
+                AND telegram_file_id IS NOT NULL AND drive_file_id IS NOT NULL
+            ORDER BY last_used DESC LIMIT 1
+        """, (ELEVENLABS_VOICE_ID, voice_text))
+        record = cursor.fetchone()
+    except Exception as e:
+        print(f"❌ Assets: DB query error: {e}", flush=True)
+        record = None
+    cursor.close()
+    conn.close()
+    if not record:
+        return None
+    audio_hash, telegram_file_id, drive_file_id, drive_url = record
+    return {"audio_hash": audio_hash, "voice_text": voice_text, "voice_data": None,
+            "telegram_file_id": telegram_file_id, "drive_file_id": drive_file_id, "drive_url": drive_url}
+
+def load_voice_clip(voice_text, regenerate=False):
+    """
+    Returns a clip dict for voice_text: audio_hash, voice_text, voice_data (binary, or None
+    for a registered clip not yet downloaded), telegram_file_id, drive_file_id and drive_url.
+    Reuses the registered clip for the same text unless regenerate is set; otherwise
+    generates a new one with ElevenLabs. Returns None if generation fails.
+    """
+    if not regenerate:
+        clip = find_audio_asset(voice_text)
+        if clip:
+            print(f"DEBUG: Reusing registered clip {clip['audio_hash'][:12]} for '{voice_text}'", flush=True)
+            return clip
+    voice_data = generate_voice_message(voice_text)
+    if not voice_data:
+        return None
+    return {"audio_hash": hash_audio(voice_data), "voice_text": voice_text, "voice_data": voice_data,
+            "telegram_file_id": None, "drive_file_id": None, "drive_url": None}
+
+def get_clip_audio(clip):
+    """
+    Returns the clip's bytes, downloading them from Telegram for registered clips.
+    """
+    if clip.get("voice_data") is None and clip.get("telegram_file_id"):
+        base_url = f"{TELEGRAM_API_BASE_URL}/bot{TELEGRAM_BOT_TOKEN}"
+        try:
+            response = requests.get(f"{base_url}/getFile", params={"file_id": clip["telegram_file_id"]})
+            file_path = response.json()["result"]["file_path"]
+            response = requests.get(f"{TELEGRAM_API_BASE_URL}/file/bot{TELEGRAM_BOT_TOKEN}/{file_path}")
+            if response.ok:
+                clip["voice_data"] = response.content
+                print(f"DEBUG: Downloaded {len(response.content)} bytes for clip {clip['audio_hash'][:12]} from Telegram", flush=True)
+        except Exception as e:
+            print(f"❌ Telegram: Could not download clip {clip['audio_hash'][:12]}: {e}", flush=True)
+    return clip.get("voice_data")
+
+def save_audio_asset(audio_hash, **fields):
+    """
+    Records fields (telegram_file_id, drive_file_id, drive_url, voice_id, voice_text)
+    for audio_hash and marks it as used now, keeping values stored for other columns.
+    """
+    conn = get_db_connection()
+    if not conn:
+        return
+    cursor = conn.cursor()
+    columns = list(fields.keys())
+    try:
+        cursor.execute(f"""
+            INSERT INTO audio_assets (sha256, {"".join(c + ", " for c in columns)}last_used)
+            VALUES (%s, {"".join("%s, " for c in columns)}NOW())
+            ON CONFLICT (sha256) DO UPDATE SET
+                {"".join(f"{c} = EXCLUDED.{c}, " for c in columns)}last_used = EXCLUDED.last_used
+        """, (audio_hash, *fields.values()))
+        conn.commit()
+        print(f"✅ Assets: Recorded {columns} for audio {audio_hash[:12]}", flush=True)
+    except Exception as e:
+        print(f"❌ Assets: DB insert error: {e}", flush=True)
+    cursor.close()
+    conn.close()
+
+
 # ---------- Database and Airtable Sync Functions ----------
 def get_db_connection():
     try:
@@ -262,6 +619,49 @@ def init_db():
         print("✅ DB: 'notes' column ensured.", flush=True)
     except Exception as e:
         print(f"⚠️ DB: Could not alter 'notes': {e}", flush=True)
+    try:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS audio_assets (
+                sha256 TEXT PRIMARY KEY,
+                telegram_file_id TEXT,
+                drive_file_id TEXT,
+                drive_url TEXT,
+                voice_id TEXT,
+                voice_text TEXT,
+                last_used TIMESTAMP DEFAULT NOW()
+            )
+        """)
+        conn.commit()
+        print("✅ DB: 'audio_assets' table ensured.", flush=True)
+    except Exception as e:
+        print(f"⚠️ DB: Could not create 'audio_assets': {e}", flush=True)
+    try:
+        cursor.execute("ALTER TABLE audio_assets ADD COLUMN IF NOT EXISTS voice_id TEXT")
+        cursor.execute("ALTER TABLE audio_assets ADD COLUMN IF NOT EXISTS voice_text TEXT")
+        cursor.execute("ALTER TABLE audio_assets ADD COLUMN IF NOT EXISTS last_used TIMESTAMP DEFAULT NOW()")
+        cursor.execute("CREATE INDEX IF NOT EXISTS audio_assets_voice_text ON audio_assets (voice_id, voice_text)")
+        conn.commit()
+        print("✅ DB: 'audio_assets' columns ensured.", flush=True)
+    except Exception as e:
+        print(f"⚠️ DB: Could not alter 'audio_assets': {e}", flush=True)
+    try:
+        # One-row table holding the long-poll offset and metrics, shared by every process
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS telegram_poll_state (
+                id INTEGER PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+                last_update_id BIGINT,
+                batches INTEGER DEFAULT 0,
+                updates INTEGER DEFAULT 0,
+                errors INTEGER DEFAULT 0,
+                last_batch_size INTEGER DEFAULT 0,
+                max_batch_size INTEGER DEFAULT 0,
+                started TIMESTAMP
+            )
+        """)
+        conn.commit()
+        print("✅ DB: 'telegram_poll_state' table ensured.", flush=True)
+    except Exception as e:
+        print(f"⚠️ DB: Could not create 'telegram_poll_state': {e}", flush=True)
     try:
         cursor.execute("ALTER TABLE simps ALTER COLUMN phone TYPE TEXT USING phone::text;")
         conn.commit()
@@ -343,6 +743,432 @@ def run_periodic_sync():
         print("🔍 Periodic sync triggered.", flush=True)
         sync_airtable_to_postgres()
 
+def run_voice_retention():
+    # Prune once at startup, then daily, so frequent restarts don't keep postponing it
+    while True:
+        print("🔍 Voice retention triggered.", flush=True)
+        try:
+            prune_voice_folder()
+        except Exception as e:
+            print(f"❌ Retention: Error pruning Voice folder: {e}", flush=True)
+        time.sleep(86400)
+
+# ---------- Telegram Update Handling ----------
+def handle_telegram_update(update):
+    """
+    Runs the bot command handlers for a single Telegram update and returns
+    the (response, status) pair. Shared by the webhook and the long-poll consumer.
+    """
+    global pending_diary, pending_voice
+    message = update.get("message", {})
+    text_message = message.get("text")
+    if not text_message:
+        print("❌ /receive_telegram_message: Missing message text.", flush=True)
+        return {"error": "Missing message text"}, 200
+
+    # If a confirmation command ("send", "next", "cancel") is received but no pending voice exists:
+    if text_message.lower() in ["send", "next", "cancel"] and not pending_voice:
+        send_to_telegram("No pending voice message.")
+        return {"status": "No pending voice message"}, 200
+
+    # Voice message command handling: expected format "prefix v/voice_text"
+    if "v/" in text_message:
+        parts = text_message.split("v/", 1)
+        prefix = parts[0].strip()   # Intended recipient info, e.g., "13"
+        voice_text = parts[1].strip()  # Text to be synthesized
+        phone = ""
+        simp_id = None
+        if prefix:
+            m = re.match(r'^(\d+)', prefix)
+            if m:
+                simp_id = int(m.group(1))
+                conn = get_db_connection()
+                if conn:
+                    cursor = conn.cursor()
+                    cursor.execute("SELECT phone FROM simps WHERE simp_id = %s", (simp_id,))
+                    record = cursor.fetchone()
+                    cursor.close()
+                    conn.close()
+                    if record:
+                        phone = record[0]
+        pending_voice = {
+            "simp_id": simp_id,
+            "voice_text": voice_text,
+            "clip": load_voice_clip(voice_text),
+            "phone": phone
+        }
+        if pending_voice["clip"]:
+            # Send an audio preview with caption "Yay or nay?"
+            if send_voice_to_telegram(pending_voice["clip"], caption="Yay or nay?"):
+                return {"status": "Voice generation triggered, awaiting confirmation"}, 200
+            pending_voice = None
+            send_to_telegram("Error sending voice preview.")
+            return {"error": "Voice preview failed"}, 200
+        else:
+            send_to_telegram("Error generating voice message.")
+            return {"error": "Voice generation failed"}, 200
+
+    # Handle confirmation for pending voice message
+    if pending_voice and text_message.lower() in ["send", "next", "cancel"]:
+        if text_message.lower() == "send":
+            file_name = pending_voice["voice_text"].replace(" ", "_") + ".mp3"
+            gdrive_url = upload_audio_to_gdrive(pending_voice["clip"], file_name)
+            if gdrive_url:
+                phone = pending_voice.get("phone", "")
+                # Replace every space with "_" in the final voice message sent to Macrodroid
+                cleaned_text = pending_voice["voice_text"].replace(" ", "_")
+                send_voice_url_to_macrodroid(gdrive_url, phone, cleaned_text)
+                send_to_telegram("Voice message sent!")
+            else:
+                send_to_telegram("Error uploading voice message to Google Drive.")
+            pending_voice = None
+            return {"status": "Voice message sent"}, 200
+        elif text_message.lower() == "next":
+            new_clip = load_voice_clip(pending_voice["voice_text"], regenerate=True)
+            if new_clip:
+                pending_voice["clip"] = new_clip
+                next_captions = [
+                    "Good or garbage? 🗑️",
+                    "Approve or disapprove? ✅",
+                    "Delete this? 🤔",
+                    "Fire or flop? 🔥",
+                    "Worth sending? 📤",
+                    "Should I be embarrassed? 😳",
+                    "Thoughts? 💭",
+                    "Did I ruin everything? 😬",
+                    "Rate this: 10 or 0? 🌟",
+                    "Would you reply? 📩",
+                    "Decent or disaster? 🚀",
+                    "Listenable or unbearable? 🎧",
+                    "Love it or leave? ❤️",
+                    "Forward this? 🔁",
+                    "Forget this happened? 🤭",
+                    "Will I regret this? 😓",
+                    "Genius or nonsense? 🧠",
+                    "Should I be proud? 🏆",
+                    "Roast or respect? 🔥",
+                    "Keep or delete? 💾",
+                    "Send to more people? 📤",
+                    "Big reaction incoming? 😮",
+                    "Waste of time? ⏳",
+                    "Thumbs up or down? 👍",
+                    "Listen again? 🔄",
+                    "Try again? 🤷",
+                    "Overthinking this? 🤔",
+                    "Worth a response? 📩",
+                    "Listen twice? 🎧",
+                    "Awful or okay? 😬",
+                    "Save or scrap? 💾",
+                    "Would this annoy you? 😡",
+                    "Passable or pathetic? 🤨",
+                    "Apology needed? 😅",
+                    "Does this make sense? 🤯",
+                    "Will this get laughs? 😂",
+                    "Shareable or shameful? 🤦",
+                    "Mom-approved? 👩‍👦",
+                    "Too much? 😳",
+                    "Say too much? 😶",
+                    "Ignore this? 🚫",
+                    "Sound normal? 🤨",
+                    "Stop talking? 🤐",
+                    "Argument starter? ⚡",
+                    "Necessary or nah? 🤔",
+                    "Rethink this? 🤦",
+                    "Bold or bad? 😵",
+                    "Anyone else get this? 🤷",
+                    "Trash this? 🗑️",
+                    "Open in public? 📢"
+                ]
+                caption = random.choice(next_captions)
+                if not send_voice_to_telegram(new_clip, caption=caption):
+                    send_to_telegram("Error sending voice preview.")
+                    return {"error": "Voice preview failed"}, 200
+            else:
+                send_to_telegram("Error generating new voice message.")
+            return {"status": "Voice message updated"}, 200
+        elif text_message.lower() == "cancel":
+            pending_voice = None
+            send_to_telegram("Voice message canceled.")
+            return {"status": "Voice message canceled"}, 200
+
+    # Process other commands (smart strings, diary, etc.)
+    smart_matches = re.findall(r'\{([^}]+)\}', text_message)
+    for key in smart_matches:
+        key_lower = key.lower()
+        if key_lower not in smart_strings:
+            error_msg = f"Message failed. Cannot find {{{key}}}."
+            print(f"🔍 {error_msg}", flush=True)
+            send_to_telegram(error_msg)
+            return {"status": "Error: Unknown smart string"}, 200
+        else:
+            text_message = text_message.replace("{" + key + "}", smart_strings[key_lower])
+    
+    if "/smartwords" in text_message:
+        wordbank_lines = [f"🪪 {{{k}}} - {v}" for k, v in smart_strings.items()]
+        wordbank_msg = "\n".join(wordbank_lines)
+        print(f"🔍 /receive_telegram_message: Sending smartwords:\n{wordbank_msg}", flush=True)
+        send_to_telegram(wordbank_msg)
+        return {"status": "Smartwords sent"}, 200
+
+    if "/diary" in text_message:
+        print("🔍 /receive_telegram_message: /diary command detected.", flush=True)
+        conn = get_db_connection()
+        if not conn:
+            return {"error": "DB connection failed"}, 200
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT simp_id, simp_name, notes, subscription FROM simps ORDER BY simp_id DESC")
+            records = cursor.fetchall()
+        except Exception as e:
+            cursor.close()
+            conn.close()
+            return {"error": "DB query failed"}, 200
+        cursor.close()
+        conn.close()
+        if not records:
+            reply_message = "No diary notes found."
+        else:
+            lines = []
+            for rec in records:
+                simp_id, simp_name, notes, subscription = rec
+                line = f"{simp_id} | {simp_name} | {notes if notes else 'empty'}"
+                lines.append(line)
+            reply_message = "\n".join(lines)
+        print(f"🔍 /receive_telegram_message: Sending diary reply:\n{reply_message}", flush=True)
+        send_to_telegram(reply_message)
+        return {"status": "Diary reply sent"}, 200
+
+    if "/note" in text_message:
+        print("🔍 /receive_telegram_message: /note command detected.", flush=True)
+        send_to_telegram("✍🏼When you're ready, leave a note on a simp. (e.g. \"8 gets paid on thursdays\")")
+        pending_diary = True
+        return {"status": "Diary update mode activated"}, 200
+
+    if pending_diary:
+        m = re.match(r'^\s*(\d+)\s*(.*)', text_message)
+        if not m:
+            print("❌ /receive_telegram_message: Could not extract simp_id from diary update.", flush=True)
+            return {"error": "Could not extract simp_id"}, 200
+        simp_id_int = int(m.group(1))
+        note_text = m.group(2)
+        conn = get_db_connection()
+        if not conn:
+            return {"error": "DB connection failed"}, 200
+        cursor = conn.cursor()
+        try:
+            cursor.execute("UPDATE simps SET notes = %s WHERE simp_id = %s", (note_text, simp_id_int))
+            conn.commit()
+            print(f"🔍 /receive_telegram_message: Updated notes for simp_id {simp_id_int} with note: {note_text}", flush=True)
+        except Exception as e:
+            cursor.close()
+            conn.close()
+            print(f"❌ /receive_telegram_message: DB update error: {e}", flush=True)
+            return {"error": "DB update failed"}, 200
+        cursor.close()
+        conn.close()
+        conn = get_db_connection()
+        if conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute("SELECT simp_name FROM simps WHERE simp_id = %s", (simp_id_int,))
+                result = cursor.fetchone()
+                simp_name = result[0] if result else f"ID {simp_id_int}"
+            except Exception as e:
+                simp_name = f"ID {simp_id_int}"
+            cursor.close()
+            conn.close()
+        else:
+            simp_name = f"ID {simp_id_int}"
+        response_text = f"{random.choice(diary_responses)} Updated {simp_name} successfully."
+        send_to_telegram(response_text)
+        pending_diary = False
+        return {"status": "Diary note updated"}, 200
+
+    if "/fetchsimps" in text_message:
+        print("🔍 /receive_telegram_message: /fetchsimps command detected.", flush=True)
+        conn = get_db_connection()
+        if not conn:
+            return {"error": "DB connection failed"}, 200
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT simp_id, simp_name, intent, subscription, duration FROM simps ORDER BY simp_id DESC")
+            records = cursor.fetchall()
+        except Exception as e:
+            cursor.close()
+            conn.close()
+            return {"error": "DB query failed"}, 200
+        cursor.close()
+        conn.close()
+        if not records:
+            reply_message = "No simps found."
+        else:
+            lines = []
+            for rec in records:
+                simp_id, simp_name, intent, subscription, duration = rec
+                line = f"{simp_id} | {simp_name} | {intent} | {duration} days"
+                lines.append(line)
+            reply_message = "\n".join(lines)
+        print(f"🔍 /receive_telegram_message: Sending fetchsimps reply:\n{reply_message}", flush=True)
+        send_to_telegram(reply_message)
+        return {"status": "Fetchsimps trigger sent"}, 200
+
+    m = re.match(r'^\s*(\d+)\s*(.*)', text_message)
+    if not m:
+        print("❌ /receive_telegram_message: Could not extract simp_id from message.", flush=True)
+        return {"error": "Could not extract simp_id"}, 200
+    simp_id_int = int(m.group(1))
+    cleaned_message = m.group(2)
+    conn = get_db_connection()
+    if not conn:
+        return {"error": "DB connection failed"}, 200
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT phone, subscription, simp_name FROM simps WHERE simp_id = %s", (simp_id_int,))
+        record = cursor.fetchone()
+    except Exception as e:
+        cursor.close()
+        conn.close()
+        return {"error": "DB query failed"}, 200
+    cursor.close()
+    conn.close()
+    if record:
+        phone, subscription, simp_name = record
+        final_message = f"{cleaned_message}"
+        print(f"🔍 /receive_telegram_message: Sending payload to Macrodroid: {final_message}", flush=True)
+        payload = {"phone": phone, "message": final_message}
+        try:
+            response = requests.post(MACROTRIGGER_BASE_URL + "/reply", json=payload)
+            print(f"🔍 /receive_telegram_message: Sent payload, response: {response.text}", flush=True)
+        except Exception as e:
+            return {"error": "Failed to send to Macrodroid"}, 200
+        return {"status": "Trigger sent"}, 200
+    else:
+        return {"error": "No record found for simp_id"}, 200
+
+# ---------- Telegram Long Polling ----------
+def start_poll_state():
+    """
+    Resets the per-run poll metrics and returns the last handled update_id
+    (None if nothing was handled yet). Raises if the state cannot be read.
+    """
+    conn = get_db_connection()
+    if not conn:
+        raise Exception("No DB connection")
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            INSERT INTO telegram_poll_state (id, started) VALUES (1, NOW())
+            ON CONFLICT (id) DO UPDATE SET
+                batches = 0, updates = 0, errors = 0,
+                last_batch_size = 0, max_batch_size = 0, started = NOW()
+            RETURNING last_update_id
+        """)
+        last_update_id = cursor.fetchone()[0]
+        conn.commit()
+    finally:
+        cursor.close()
+        conn.close()
+    return last_update_id
+
+def update_poll_state(assignments, params=()):
+    conn = get_db_connection()
+    if not conn:
+        print(f"❌ Poll: No DB connection, could not record '{assignments}'", flush=True)
+        return
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f"UPDATE telegram_poll_state SET {assignments} WHERE id = 1", params)
+        conn.commit()
+    except Exception as e:
+        print(f"❌ Poll: DB update error: {e}", flush=True)
+    cursor.close()
+    conn.close()
+
+def run_telegram_poller():
+    """
+    getUpdates consumer. Updates are handled one at a time in update_id order on
+    this thread, since the handlers share the bot's global state. Telegram's offset
+    acknowledges each batch; the first call after a restart sends no offset, so
+    Telegram resumes from its own acknowledged position. Each handled update_id is
+    also stored in telegram_poll_state: if the first batch still contains it, the
+    updates up to it were handled before the restart and are skipped. A stored id
+    above every id in that batch means Telegram's ids went backwards (a week without
+    updates or a new bot token), so it is discarded.
+    """
+    base_url = f"{TELEGRAM_API_BASE_URL}/bot{TELEGRAM_BOT_TOKEN}"
+    # getUpdates is rejected while a webhook is set
+    try:
+        response = requests.post(f"{base_url}/deleteWebhook", timeout=10)
+        print(f"🔍 Poll: deleteWebhook response: {response.text}", flush=True)
+    except Exception as e:
+        print(f"❌ Poll: deleteWebhook failed: {e}", flush=True)
+    try:
+        stored_update_id = start_poll_state()
+        print(f"🔍 Poll: Last handled update before restart: {stored_update_id}", flush=True)
+    except Exception as e:
+        print(f"⚠️ Poll: Could not load stored update id ({e}); relying on Telegram's offset only.", flush=True)
+        stored_update_id = None
+    last_update_id = None  # skips redeliveries within this run
+    offset = None
+    backoff = 1
+    while True:
+        params = {"timeout": TELEGRAM_POLL_TIMEOUT, "limit": TELEGRAM_POLL_BATCH_SIZE, "allowed_updates": ["message"]}
+        if offset is not None:
+            params["offset"] = offset
+        call_started = time.time()
+        try:
+            response = requests.post(f"{base_url}/getUpdates", json=params, timeout=TELEGRAM_POLL_TIMEOUT + 10)
+            body = response.json()
+            ok = response.ok and body.get("ok")
+        except Exception as e:
+            body = {"description": str(e)}
+            ok = False
+        if not ok:
+            # 409 (webhook set / second consumer), 401 (bad token), 429 (flood control), network errors
+            retry_after = (body.get("parameters") or {}).get("retry_after")
+            delay = retry_after if retry_after else backoff
+            print(f"❌ Poll: getUpdates failed ({body.get('error_code')}): {body.get('description')}; retrying in {delay}s", flush=True)
+            update_poll_state("errors = errors + 1")
+            time.sleep(delay)
+            backoff = min(backoff * 2, 60)
+            continue
+        backoff = 1
+        updates = body.get("result", [])
+        if not updates:
+            if time.time() - call_started < TELEGRAM_POLL_TIMEOUT:
+                time.sleep(1)
+            continue
+        update_ids = [u["update_id"] for u in updates]
+        if stored_update_id is not None:
+            if min(update_ids) <= stored_update_id <= max(update_ids):
+                last_update_id = stored_update_id
+            elif stored_update_id > max(update_ids):
+                print(f"⚠️ Poll: update_ids went backwards (stored {stored_update_id}, got {min(update_ids)}-{max(update_ids)}); resetting.", flush=True)
+                update_poll_state("last_update_id = NULL")
+            stored_update_id = None
+        elif last_update_id is not None and max(update_ids) < last_update_id:
+            print(f"⚠️ Poll: update_ids went backwards (last {last_update_id}, got {min(update_ids)}-{max(update_ids)}); resetting.", flush=True)
+            last_update_id = None
+            update_poll_state("last_update_id = NULL")
+        for update in sorted(updates, key=lambda u: u["update_id"]):
+            update_id = update["update_id"]
+            if last_update_id is not None and update_id <= last_update_id:
+                print(f"🔍 Poll: Update {update_id} already handled. Skipping.", flush=True)
+                continue
+            try:
+                result, status = handle_telegram_update(update)
+                print(f"🔍 Poll: Update {update_id} handled: {result}", flush=True)
+            except Exception as e:
+                print(f"❌ Poll: Error handling update {update_id}: {e}", flush=True)
+                update_poll_state("errors = errors + 1")
+            last_update_id = update_id
+            update_poll_state("last_update_id = %s, updates = updates + 1", (update_id,))
+        offset = max(update_ids) + 1
+        update_poll_state("batches = batches + 1, last_batch_size = %s, max_batch_size = GREATEST(max_batch_size, %s)",
+                          (len(updates), len(updates)))
+        print(f"🔍 Poll: Processed batch of {len(updates)} update(s), next offset {offset}", flush=True)
+
+
 # ---------- Flask App ----------
 def create_app():
     app = Flask(__name__)
@@ -352,6 +1178,13 @@ def create_app():
     with app.app_context():
         init_db()
     threading.Thread(target=run_periodic_sync, daemon=True).start()
+    if TEXT_COALESCE_WINDOW > 0:
+        atexit.register(flush_all_inbound_texts)
+    if VOICE_RETENTION_DAYS > 0 and DRIVE_VOICE_FOLDER_ID:
+        threading.Thread(target=run_voice_retention, daemon=True).start()
+    if TELEGRAM_MODE == "poll":
+        print("🔍 App: Telegram long-poll mode enabled.", flush=True)
+        threading.Thread(target=run_telegram_poller, daemon=True).start()
 
     @app.route("/receive_text", methods=["POST"])
     def receive_text():
@@ -363,6 +1196,9 @@ def create_app():
         if not phone_number or not text_message:
             print("❌ /receive_text: Missing phone number or message.", flush=True)
             return {"error": "Missing phone number or message"}, 400
+        if TEXT_COALESCE_WINDOW > 0:
+            queue_inbound_text(phone_number, text_message)
+            return {"status": "Message queued"}, 200
         conn = get_db_connection()
         if not conn:
             print("❌ /receive_text: DB connection failed.", flush=True)
@@ -374,17 +1210,57 @@ def create_app():
         conn.close()
         if simp:
             simp_id, simp_name, subscription = simp
-            emoji = ""  # For text messages, adjust as desired.
-            m = re.match(r'^\s*\d+\s*(.*)', text_message)
-            cleaned_message = m.group(1) if m else text_message
-            formatted_message = f"{emoji}{simp_id} | {simp_name}: {cleaned_message}"
-            print(f"🔍 /receive_text: Forwarding formatted message: '{formatted_message}'", flush=True)
-            send_to_telegram(formatted_message)
+            for formatted_message in format_inbound_text(simp_id, simp_name, [text_message]):
+                print(f"🔍 /receive_text: Forwarding formatted message: '{formatted_message}'", flush=True)
+                send_to_telegram(formatted_message)
             return {"status": "Message sent"}, 200
         else:
             print("❌ /receive_text: Phone number not found in DB.", flush=True)
             return {"error": "Phone number not found"}, 404
 
+    @app.route("/coalesce_stats", methods=["GET"])
+    def get_coalesce_stats():
+        with pending_texts_lock:
+            stats = dict(coalesce_stats)
+            stats["pending"] = sum(len(v) for v in pending_texts.values())
+        stats["window"] = TEXT_COALESCE_WINDOW
+        return stats
+
+    @app.route("/poll_stats", methods=["GET"])
+    def get_poll_stats():
+        conn = get_db_connection()
+        if not conn:
+            return {"error": "DB connection failed"}, 500
+        cursor = conn.cursor()
+        try:
+            cursor.execute("""
+                SELECT last_update_id, batches, updates, errors, last_batch_size, max_batch_size,
+                       started, EXTRACT(EPOCH FROM NOW() - started)
+                FROM telegram_poll_state WHERE id = 1
+            """)
+            record = cursor.fetchone()
+        except Exception as e:
+            cursor.close()
+            conn.close()
+            return {"error": "DB query failed"}, 500
+        cursor.close()
+        conn.close()
+        stats = {"mode": TELEGRAM_MODE}
+        if record:
+            last_update_id, batches, updates, errors, last_batch_size, max_batch_size, started, elapsed = record
+            stats.update({
+                "last_update_id": last_update_id,
+                "batches": batches,
+                "updates": updates,
+                "errors": errors,
+                "last_batch_size": last_batch_size,
+                "max_batch_size": max_batch_size,
+                "started": str(started),
+                "updates_per_sec": round(updates / float(elapsed), 3) if elapsed else 0,
+                "avg_batch_size": round(updates / batches, 2) if batches else 0
+            })
+        return stats
+
     @app.route("/check_db", methods=["GET"])
     def check_db():
         conn = get_db_connection()
@@ -405,295 +1281,20 @@ def create_app():
 
     @app.route("/receive_telegram_message", methods=["POST"])
     def receive_telegram_message():
-        global pending_diary, pending_voice
         print("🔍 /receive_telegram_message: Received a POST request", flush=True)
         update = request.json
         print(f"🔍 /receive_telegram_message: Update received: {update}", flush=True)
+        if TELEGRAM_MODE == "poll":
+            # Updates are consumed by the poller; handling them here too would split the bot state
+            print("❌ /receive_telegram_message: Webhook disabled in poll mode.", flush=True)
+            return {"error": "Webhook disabled in poll mode"}, 409
         update_id = update.get("update_id")
         if update_id in processed_updates:
             print(f"🔍 Duplicate update {update_id} received. Ignoring.", flush=True)
             return {"status": "OK"}, 200
         else:
             processed_updates.add(update_id)
-        message = update.get("message", {})
-        text_message = message.get("text")
-        if not text_message:
-            print("❌ /receive_telegram_message: Missing message text.", flush=True)
-            return {"error": "Missing message text"}, 200
-
-        # If a confirmation command ("send", "next", "cancel") is received but no pending voice exists:
-        if text_message.lower() in ["send", "next", "cancel"] and not pending_voice:
-            send_to_telegram("No pending voice message.")
-            return {"status": "No pending voice message"}, 200
-
-        # Voice message command handling: expected format "prefix v/voice_text"
-        if "v/" in text_message:
-            parts = text_message.split("v/", 1)
-            prefix = parts[0].strip()   # Intended recipient info, e.g., "13"
-            voice_text = parts[1].strip()  # Text to be synthesized
-            phone = ""
-            simp_id = None
-            if prefix:
-                m = re.match(r'^(\d+)', prefix)
-                if m:
-                    simp_id = int(m.group(1))
-                    conn = get_db_connection()
-                    if conn:
-                        cursor = conn.cursor()
-                        cursor.execute("SELECT phone FROM simps WHERE simp_id = %s", (simp_id,))
-                        record = cursor.fetchone()
-                        cursor.close()
-                        conn.close()
-                        if record:
-                            phone = record[0]
-            pending_voice = {
-                "simp_id": simp_id,
-                "voice_text": voice_text,
-                "voice_data": generate_voice_message(voice_text),
-                "phone": phone
-            }
-            if pending_voice["voice_data"]:
-                # Send an audio preview with caption "Yay or nay?"
-                send_voice_to_telegram(pending_voice["voice_data"], caption="Yay or nay?")
-                return {"status": "Voice generation triggered, awaiting confirmation"}, 200
-            else:
-                send_to_telegram("Error generating voice message.")
-                return {"error": "Voice generation failed"}, 200
-
-        # Handle confirmation for pending voice message
-        if pending_voice and text_message.lower() in ["send", "next", "cancel"]:
-            if text_message.lower() == "send":
-                file_name = pending_voice["voice_text"].replace(" ", "_") + ".mp3"
-                gdrive_url = upload_audio_to_gdrive(pending_voice["voice_data"], file_name)
-                if gdrive_url:
-                    phone = pending_voice.get("phone", "")
-                    # Replace every space with "_" in the final voice message sent to Macrodroid
-                    cleaned_text = pending_voice["voice_text"].replace(" ", "_")
-                    send_voice_url_to_macrodroid(gdrive_url, phone, cleaned_text)
-                    send_to_telegram("Voice message sent!")
-                else:
-                    send_to_telegram("Error uploading voice message to Google Drive.")
-                pending_voice = None
-                return {"status": "Voice message sent"}, 200
-            elif text_message.lower() == "next":
-                new_voice_data = generate_voice_message(pending_voice["voice_text"])
-                if new_voice_data:
-                    pending_voice["voice_data"] = new_voice_data
-                    next_captions = [
-                        "Good or garbage? 🗑️",
-                        "Approve or disapprove? ✅",
-                        "Delete this? 🤔",
-                        "Fire or flop? 🔥",
-                        "Worth sending? 📤",
-                        "Should I be embarrassed? 😳",
-                        "Thoughts? 💭",
-                        "Did I ruin everything? 😬",
-                        "Rate this: 10 or 0? 🌟",
-                        "Would you reply? 📩",
-                        "Decent or disaster? 🚀",
-                        "Listenable or unbearable? 🎧",
-                        "Love it or leave? ❤️",
-                        "Forward this? 🔁",
-                        "Forget this happened? 🤭",
-                        "Will I regret this? 😓",
-                        "Genius or nonsense? 🧠",
-                        "Should I be proud? 🏆",
-                        "Roast or respect? 🔥",
-                        "Keep or delete? 💾",
-                        "Send to more people? 📤",
-                        "Big reaction incoming? 😮",
-                        "Waste of time? ⏳",
-                        "Thumbs up or down? 👍",
-                        "Listen again? 🔄",
-                        "Try again? 🤷",
-                        "Overthinking this? 🤔",
-                        "Worth a response? 📩",
-                        "Listen twice? 🎧",
-                        "Awful or okay? 😬",
-                        "Save or scrap? 💾",
-                        "Would this annoy you? 😡",
-                        "Passable or pathetic? 🤨",
-                        "Apology needed? 😅",
-                        "Does this make sense? 🤯",
-                        "Will this get laughs? 😂",
-                        "Shareable or shameful? 🤦",
-                        "Mom-approved? 👩‍👦",
-                        "Too much? 😳",
-                        "Say too much? 😶",
-                        "Ignore this? 🚫",
-                        "Sound normal? 🤨",
-                        "Stop talking? 🤐",
-                        "Argument starter? ⚡",
-                        "Necessary or nah? 🤔",
-                        "Rethink this? 🤦",
-                        "Bold or bad? 😵",
-                        "Anyone else get this? 🤷",
-                        "Trash this? 🗑️",
-                        "Open in public? 📢"
-                    ]
-                    caption = random.choice(next_captions)
-                    send_voice_to_telegram(new_voice_data, caption=caption)
-                else:
-                    send_to_telegram("Error generating new voice message.")
-                return {"status": "Voice message updated"}, 200
-            elif text_message.lower() == "cancel":
-                pending_voice = None
-                send_to_telegram("Voice message canceled.")
-                return {"status": "Voice message canceled"}, 200
-
-        # Process other commands (smart strings, diary, etc.)
-        smart_matches = re.findall(r'\{([^}]+)\}', text_message)
-        for key in smart_matches:
-            key_lower = key.lower()
-            if key_lower not in smart_strings:
-                error_msg = f"Message failed. Cannot find {{{key}}}."
-                print(f"🔍 {error_msg}", flush=True)
-                send_to_telegram(error_msg)
-                return {"status": "Error: Unknown smart string"}, 200
-            else:
-                text_message = text_message.replace("{" + key + "}", smart_strings[key_lower])
-        
-        if "/smartwords" in text_message:
-            wordbank_lines = [f"🪪 {{{k}}} - {v}" for k, v in smart_strings.items()]
-            wordbank_msg = "\n".join(wordbank_lines)
-            print(f"🔍 /receive_telegram_message: Sending smartwords:\n{wordbank_msg}", flush=True)
-            send_to_telegram(wordbank_msg)
-            return {"status": "Smartwords sent"}, 200
-
-        if "/diary" in text_message:
-            print("🔍 /receive_telegram_message: /diary command detected.", flush=True)
-            conn = get_db_connection()
-            if not conn:
-                return {"error": "DB connection failed"}, 200
-            cursor = conn.cursor()
-            try:
-                cursor.execute("SELECT simp_id, simp_name, notes, subscription FROM simps ORDER BY simp_id DESC")
-                records = cursor.fetchall()
-            except Exception as e:
-                cursor.close()
-                conn.close()
-                return {"error": "DB query failed"}, 200
-            cursor.close()
-            conn.close()
-            if not records:
-                reply_message = "No diary notes found."
-            else:
-                lines = []
-                for rec in records:
-                    simp_id, simp_name, notes, subscription = rec
-                    line = f"{simp_id} | {simp_name} | {notes if notes else 'empty'}"
-                    lines.append(line)
-                reply_message = "\n".join(lines)
-            print(f"🔍 /receive_telegram_message: Sending diary reply:\n{reply_message}", flush=True)
-            send_to_telegram(reply_message)
-            return {"status": "Diary reply sent"}, 200
-
-        if "/note" in text_message:
-            print("🔍 /receive_telegram_message: /note command detected.", flush=True)
-            send_to_telegram("✍🏼When you're ready, leave a note on a simp. (e.g. \"8 gets paid on thursdays\")")
-            pending_diary = True
-            return {"status": "Diary update mode activated"}, 200
-
-        if pending_diary:
-            m = re.match(r'^\s*(\d+)\s*(.*)', text_message)
-            if not m:
-                print("❌ /receive_telegram_message: Could not extract simp_id from diary update.", flush=True)
-                return {"error": "Could not extract simp_id"}, 200
-            simp_id_int = int(m.group(1))
-            note_text = m.group(2)
-            conn = get_db_connection()
-            if not conn:
-                return {"error": "DB connection failed"}, 200
-            cursor = conn.cursor()
-            try:
-                cursor.execute("UPDATE simps SET notes = %s WHERE simp_id = %s", (note_text, simp_id_int))
-                conn.commit()
-                print(f"🔍 /receive_telegram_message: Updated notes for simp_id {simp_id_int} with note: {note_text}", flush=True)
-            except Exception as e:
-                cursor.close()
-                conn.close()
-                print(f"❌ /receive_telegram_message: DB update error: {e}", flush=True)
-                return {"error": "DB update failed"}, 200
-            cursor.close()
-            conn.close()
-            conn = get_db_connection()
-            if conn:
-                cursor = conn.cursor()
-                try:
-                    cursor.execute("SELECT simp_name FROM simps WHERE simp_id = %s", (simp_id_int,))
-                    result = cursor.fetchone()
-                    simp_name = result[0] if result else f"ID {simp_id_int}"
-                except Exception as e:
-                    simp_name = f"ID {simp_id_int}"
-                cursor.close()
-                conn.close()
-            else:
-                simp_name = f"ID {simp_id_int}"
-            response_text = f"{random.choice(diary_responses)} Updated {simp_name} successfully."
-            send_to_telegram(response_text)
-            pending_diary = False
-            return {"status": "Diary note updated"}, 200
-
-        if "/fetchsimps" in text_message:
-            print("🔍 /receive_telegram_message: /fetchsimps command detected.", flush=True)
-            conn = get_db_connection()
-            if not conn:
-                return {"error": "DB connection failed"}, 200
-            cursor = conn.cursor()
-            try:
-                cursor.execute("SELECT simp_id, simp_name, intent, subscription, duration FROM simps ORDER BY simp_id DESC")
-                records = cursor.fetchall()
-            except Exception as e:
-                cursor.close()
-                conn.close()
-                return {"error": "DB query failed"}, 200
-            cursor.close()
-            conn.close()
-            if not records:
-                reply_message = "No simps found."
-            else:
-                lines = []
-                for rec in records:
-                    simp_id, simp_name, intent, subscription, duration = rec
-                    line = f"{simp_id} | {simp_name} | {intent} | {duration} days"
-                    lines.append(line)
-                reply_message = "\n".join(lines)
-            print(f"🔍 /receive_telegram_message: Sending fetchsimps reply:\n{reply_message}", flush=True)
-            send_to_telegram(reply_message)
-            return {"status": "Fetchsimps trigger sent"}, 200
-
-        m = re.match(r'^\s*(\d+)\s*(.*)', text_message)
-        if not m:
-            print("❌ /receive_telegram_message: Could not extract simp_id from message.", flush=True)
-            return {"error": "Could not extract simp_id"}, 200
-        simp_id_int = int(m.group(1))
-        cleaned_message = m.group(2)
-        conn = get_db_connection()
-        if not conn:
-            return {"error": "DB connection failed"}, 200
-        cursor = conn.cursor()
-        try:
-            cursor.execute("SELECT phone, subscription, simp_name FROM simps WHERE simp_id = %s", (simp_id_int,))
-            record = cursor.fetchone()
-        except Exception as e:
-            cursor.close()
-            conn.close()
-            return {"error": "DB query failed"}, 200
-        cursor.close()
-        conn.close()
-        if record:
-            phone, subscription, simp_name = record
-            final_message = f"{cleaned_message}"
-            print(f"🔍 /receive_telegram_message: Sending payload to Macrodroid: {final_message}", flush=True)
-            payload = {"phone": phone, "message": final_message}
-            try:
-                response = requests.post(MACROTRIGGER_BASE_URL + "/reply", json=payload)
-                print(f"🔍 /receive_telegram_message: Sent payload, response: {response.text}", flush=True)
-            except Exception as e:
-                return {"error": "Failed to send to Macrodroid"}, 200
-            return {"status": "Trigger sent"}, 200
-        else:
-            return {"error": "No record found for simp_id"}, 200
+        return handle_telegram_update(update)
 
     return app
 
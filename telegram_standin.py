@@ -0,0 +1,128 @@
+"""
+Local Telegram Bot API stand-in for exercising TELEGRAM_MODE=poll without Telegram.
+
+Run it, then point the app at it:
+    python telegram_standin.py
+    TELEGRAM_MODE=poll TELEGRAM_BOT_TOKEN=test TELEGRAM_API_BASE_URL=http://127.0.0.1:8081 python app.py
+
+Queue updates with POST /updates {"text": "...", "chat_id": 1}, read the bot's replies
+with GET /sent, and make the next getUpdates calls fail with
+POST /fail {"error_code": 409, "count": 2, "retry_after": 1}.
+
+    python telegram_standin.py --check
+runs the app's poller against the stand-in and checks update ordering,
+offset acknowledgement and back-off on getUpdates errors.
+"""
+import os
+import sys
+import time
+import threading
+from flask import Flask, request
+from werkzeug.serving import make_server
+
+STANDIN_PORT = int(os.getenv("STANDIN_PORT", "8081"))
+
+standin = Flask(__name__)
+state_lock = threading.Condition()
+queued_updates = []   # updates not yet acknowledged via getUpdates offset
+sent_messages = []    # texts/captions the bot sent back
+failures = []         # pending error responses for getUpdates
+counters = {"next_update_id": 1, "get_updates_calls": 0, "failed_calls": 0}
+
+
+@standin.route("/updates", methods=["POST"])
+def queue_update():
+    data = request.json
+    with state_lock:
+        update = {
+            "update_id": counters["next_update_id"],
+            "message": {"chat": {"id": data.get("chat_id", 1)}, "text": data["text"]}
+        }
+        counters["next_update_id"] += 1
+        queued_updates.append(update)
+        state_lock.notify_all()
+    return update
+
+
+@standin.route("/sent", methods=["GET"])
+def get_sent():
+    with state_lock:
+        return {"sent": list(sent_messages), "pending": len(queued_updates), **counters}
+
+
+@standin.route("/fail", methods=["POST"])
+def queue_failure():
+    data = request.json
+    with state_lock:
+        for _ in range(data.get("count", 1)):
+            failures.append(data)
+    return {"status": "OK"}
+
+
+@standin.route("/bot<token>/<method>", methods=["GET", "POST"])
+def bot_api(token, method):
+    params = request.get_json(silent=True) or request.values.to_dict()
+    if method == "getUpdates":
+        with state_lock:
+            counters["get_updates_calls"] += 1
+            if failures:
+                failure = failures.pop(0)
+                counters["failed_calls"] += 1
+                body = {"ok": False, "error_code": failure["error_code"], "description": "stand-in failure"}
+                if failure.get("retry_after"):
+                    body["parameters"] = {"retry_after": failure["retry_after"]}
+                return body, failure["error_code"]
+            offset = params.get("offset")
+            if offset is not None:
+                queued_updates[:] = [u for u in queued_updates if u["update_id"] >= int(offset)]
+            if not queued_updates:
+                state_lock.wait(timeout=int(params.get("timeout", 0)))
+            return {"ok": True, "result": queued_updates[:int(params.get("limit", 100))]}
+    if method == "sendMessage":
+        with state_lock:
+            sent_messages.append(params.get("text"))
+        return {"ok": True, "result": {"message_id": len(sent_messages)}}
+    if method == "sendAudio":
+        with state_lock:
+            sent_messages.append(params.get("caption"))
+        return {"ok": True, "result": {"audio": {"file_id": f"standin-{len(sent_messages)}"}}}
+    if method == "deleteWebhook":
+        return {"ok": True, "result": True}
+    return {"ok": False, "error_code": 404, "description": "Not Found"}, 404
+
+
+def run_check():
+    server = make_server("127.0.0.1", STANDIN_PORT, standin, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{STANDIN_PORT}"
+    client = standin.test_client()
+    client.post("/fail", json={"error_code": 409, "count": 2, "retry_after": 1})
+    for chat_id, text in [(1, "/smartwords"), (1, "cancel"), (2, "/smartwords"), (1, "cancel")]:
+        client.post("/updates", json={"chat_id": chat_id, "text": text})
+
+    os.environ.setdefault("DATABASE_URL", "postgresql://standin@127.0.0.1:1/standin")
+    os.environ.update(TELEGRAM_MODE="poll", TELEGRAM_BOT_TOKEN="test",
+                      TELEGRAM_API_BASE_URL=base_url, TELEGRAM_POLL_TIMEOUT="1")
+    import app  # starts the poller
+
+    deadline = time.time() + 20
+    while time.time() < deadline and len(client.get("/sent").json["sent"]) < 4:
+        time.sleep(0.2)
+    time.sleep(1.5)  # let the next getUpdates acknowledge the batch
+    result = client.get("/sent").json
+    smartwords = "\n".join(f"🪪 {{{k}}} - {v}" for k, v in app.smart_strings.items())
+    expected = [smartwords, "No pending voice message.", smartwords, "No pending voice message."]
+    assert result["sent"] == expected, result["sent"]
+    assert result["failed_calls"] == 2, result
+    assert result["get_updates_calls"] < 20, result
+    assert result["pending"] == 0, result
+    print(f"✅ Stand-in check passed: {result['get_updates_calls']} getUpdates calls, "
+          f"{result['failed_calls']} failures backed off, {len(result['sent'])} replies in order.", flush=True)
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    if "--check" in sys.argv:
+        run_check()
+    else:
+        standin.run(host="0.0.0.0", port=STANDIN_PORT, threaded=True)